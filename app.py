@@ -13,10 +13,12 @@ from services import (
     ler_funcionarios_df,
     adicionar_funcionario,
     gerar_relatorio_organizado_df,
+    query_relatorio,
     gerar_arquivo_excel,
     ler_empresas,
     importar_funcionarios_em_massa,
-    excluir_funcionario
+    excluir_funcionario,
+    init_db
 )
 
 st.set_page_config(
@@ -47,6 +49,12 @@ def carregar_css_customizado():
 
 carregar_css_customizado()
 
+@st.cache_resource
+def preparar_banco():
+    init_db()
+
+preparar_banco()
+
 if 'user_info' not in st.session_state:
     st.session_state.user_info = None
 if 'edit_id' not in st.session_state:
@@ -112,10 +120,7 @@ def tela_funcionario():
 
     with tab2:
         st.header("Meus Registros")
-        meus_registros_df = ler_registros_df()
-        meus_registros_df = meus_registros_df[
-            meus_registros_df['Código Forte'] == st.session_state.user_info['codigo']
-        ]
+        meus_registros_df = ler_registros_df(codigo=st.session_state.user_info['codigo'])
 
         if meus_registros_df.empty:
             st.info("Você ainda não possui registros de ponto.")
@@ -126,7 +131,7 @@ def tela_funcionario():
 
             for _, row in df_visualizacao.iterrows():
                 with st.container(border=True):
-                    data_br = datetime.strptime(row['Data'], '%Y-%m-%d').strftime('%d/%m/%Y')
+                    data_br = row['Data'].strftime('%d/%m/%Y')
 
                     diff = int(row['Diferença (min)']) if pd.notnull(row['Diferença (min)']) else 0
                     cor_diff = "green" if diff == 0 else "red" if diff > 0 else "lightgray"
@@ -138,7 +143,7 @@ def tela_funcionario():
                         m = re.search(r'\d+', str(filial_raw))
                         filial = int(m.group()) if m else None
 
-                    data_evento = datetime.strptime(row['Data'], '%Y-%m-%d').date()
+                    data_evento = row['Data'].date()
                     hora_reg = datetime.strptime(row['Hora'], '%H:%M:%S').time()
                     dt_reg = datetime.combine(data_evento, hora_reg)
 
@@ -251,39 +256,30 @@ def tela_admin():
         st.divider()
         st.header("Relatório de Pontos")
 
-        df_registros = ler_registros_df()
-        df_filtrado = df_registros.copy()
-
-        if empresa_selecionada_id != 0:
-            df_filtrado = df_filtrado[df_filtrado['Empresa'] == opcoes_empresas[empresa_selecionada_id]]
-        if filial_selecionada != "Todas as Filiais":
-            df_filtrado = df_filtrado[df_filtrado['Filial'] == filial_selecionada]
-        if setor_selecionado != "Todos os Setores":
-            df_filtrado = df_filtrado[df_filtrado['Setor'] == setor_selecionado]
-
+        cod_forte_escolhido = None
         if funcionario_selecionado != "Todos os Funcionários":
             import re as _re
             m = _re.search(r"\((.*?)\)$", funcionario_selecionado)
             cod_forte_escolhido = m.group(1) if m else None
-            if cod_forte_escolhido:
-                df_filtrado = df_filtrado[df_filtrado['Código Forte'] == cod_forte_escolhido]
-
 
-        if not df_filtrado.empty:
-            df_filtrado['Data_dt'] = pd.to_datetime(df_filtrado['Data'], format='%Y-%m-%d', errors='coerce').dt.date
-            df_filtrado = df_filtrado.dropna(subset=['Data_dt'])
-            df_filtrado = df_filtrado[(df_filtrado['Data_dt'] >= data_inicio) & (df_filtrado['Data_dt'] <= data_fim)]
+        filtros_registros = dict(
+            empresa_id=int(empresa_selecionada_id) if empresa_selecionada_id != 0 else None,
+            filial=filial_selecionada if filial_selecionada != "Todas as Filiais" else None,
+            setor=setor_selecionado if setor_selecionado != "Todos os Setores" else None,
+            codigo=cod_forte_escolhido,
+        )
+        df_filtrado = ler_registros_df(data_inicio, data_fim, **filtros_registros)
 
         if df_filtrado.empty:
             st.info("Nenhum registro encontrado para os filtros selecionados.")
         else:
             st.subheader("Visualização dos Eventos")
-            df_visualizacao = df_filtrado.sort_values(by=["Data_dt", "Hora"], ascending=False)
+            df_visualizacao = df_filtrado.sort_values(by=["Data", "Hora"], ascending=False)
 
             for index, row in df_visualizacao.iterrows():
                 registro_id = row['ID']
                 with st.container(border=True):
-                    data_br = row['Data_dt'].strftime('%d/%m/%Y')
+                    data_br = row['Data'].strftime('%d/%m/%Y')
 
                     filial_raw = row['Filial']
                     try:
@@ -292,7 +288,7 @@ def tela_admin():
                         m = re.search(r'\d+', str(filial_raw))
                         filial = int(m.group()) if m else None
 
-                    data_evento = datetime.strptime(row['Data'], '%Y-%m-%d').date()
+                    data_evento = row['Data'].date()
                     hora_reg = datetime.strptime(row['Hora'], '%H:%M:%S').time()
                     dt_reg = datetime.combine(data_evento, hora_reg)
 
@@ -362,13 +358,15 @@ def tela_admin():
                 nome_empresa_relatorio = "Todas as Empresas"
                 cnpj_relatorio = None
 
-            df_organizado = gerar_relatorio_organizado_df(df_filtrado)
-            df_bruto = df_filtrado.sort_values(by=["Data_dt", "Hora"]).copy()
-            df_bruto['Data'] = pd.to_datetime(df_bruto['Data']).dt.strftime('%d/%m/%Y')
+            df_organizado = gerar_relatorio_organizado_df(
+                query_relatorio(data_inicio, data_fim, **filtros_registros)
+            )
+            df_bruto = df_filtrado.sort_values(by=["Data", "Hora"]).copy()
+            df_bruto['Data'] = df_bruto['Data'].dt.strftime('%d/%m/%Y')
 
             excel_buffer = gerar_arquivo_excel(
                 df_organizado,
-                df_bruto.drop(columns=['Data_dt']),
+                df_bruto,
                 nome_empresa_relatorio,
                 cnpj_relatorio,
                 data_inicio,
@@ -8,4 +8,9 @@ TOLERANCIA_MINUTOS = 5
 HORARIOS_PADRAO = {
     "Entrada": time(8, 0, 0),
     "Saída": time(18, 0, 0)
+}
+
+HORARIOS_POR_FILIAL = {
+    3: {"Entrada": time(7, 30, 0), "Saída": time(17, 30, 0)},
+    4: {"Entrada": time(7, 30, 0), "Saída": time(17, 30, 0)},
 }
\ No newline at end of file
@@ -1,19 +1,28 @@
 import os
 import re
 import io
+import csv
+import hmac
 import hashlib
+import functools
+import threading
+import time as _time
 import numpy as np
 import pandas as pd
 from typing import Optional, Dict, Any
 from datetime import datetime, time
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
+import psycopg2.pool
+from argon2.low_level import Type, hash_secret_raw
 from sqlalchemy import create_engine, text as _sqltext
 
-from config import FUSO_HORARIO, HORARIOS_PADRAO, TOLERANCIA_MINUTOS
+from config import FUSO_HORARIO, HORARIOS_PADRAO, HORARIOS_POR_FILIAL, TOLERANCIA_MINUTOS
 
 
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -32,39 +41,152 @@ engine = create_engine(
     future=True,
 )
 
-def query_df(sql: str, params: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
-
-    with engine.connect() as conn:
-        return pd.read_sql(_sqltext(sql), conn, params=params or {})
+QUERY_CHUNKSIZE = 50_000
+
+def query_df(sql: str, params: Optional[Dict[str, Any]] = None, stream: bool = False,
+             dtype: Optional[Dict[str, Any]] = None, parse_dates=None) -> pd.DataFrame:
+
+    if not stream:
+        with engine.connect() as conn:
+            return pd.read_sql_query(_sqltext(sql), conn, params=params or {}, dtype=dtype, parse_dates=parse_dates)
+    # Só para leituras grandes: cursor do lado do servidor, com as linhas
+    # chegando em blocos de QUERY_CHUNKSIZE em vez de todo o resultado de uma vez.
+    with engine.connect().execution_options(stream_results=True) as conn:
+        df = pd.concat(
+            pd.read_sql_query(_sqltext(sql), conn, params=params or {}, chunksize=QUERY_CHUNKSIZE,
+                              parse_dates=parse_dates),
+            ignore_index=True,
+        )
+    # dtype só depois do concat: blocos com categorias diferentes voltariam como object.
+    return df.astype(dtype) if dtype else df
 
 _u = urlparse(DATABASE_URL)
 DB_HOST, DB_PORT, DB_NAME = _u.hostname, _u.port, _u.path[1:]
 DB_USER, DB_PASS = _u.username, _u.password
 
+_DSN = dict(
+    dbname=DB_NAME,
+    user=DB_USER,
+    password=DB_PASS,
+    host=DB_HOST,
+    port=DB_PORT,
+    sslmode="require",
+    connect_timeout=5,
+    keepalives=1,
+    keepalives_idle=30,
+    keepalives_interval=10,
+    keepalives_count=5,
+)
+
+POOL_MAXCONN = 30
+POOL_ESPERA_SEGUNDOS = 10
+
+_pool = None
+_pool_lock = threading.Lock()
+# getconn() levanta PoolError na hora quando todas as conexões estão em uso;
+# o semáforo faz a requisição esperar por uma vaga por até POOL_ESPERA_SEGUNDOS.
+_pool_vagas = threading.BoundedSemaphore(POOL_MAXCONN)
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    minconn=5,
+                    maxconn=POOL_MAXCONN,
+                    cursor_factory=psycopg2.extras.RealDictCursor,
+                    **_DSN,
+                )
+    return _pool
+
 @contextmanager
 def get_db_connection():
-
-    conn_str = (
-        f"dbname={DB_NAME} user={DB_USER} password={DB_PASS} "
-        f"host={DB_HOST} port={DB_PORT} sslmode=require "
-        f"connect_timeout=5 keepalives=1 keepalives_idle=30 "
-        f"keepalives_interval=10 keepalives_count=5"
-    )
-    conn = psycopg2.connect(conn_str, cursor_factory=psycopg2.extras.RealDictCursor)
+    if not _pool_vagas.acquire(timeout=POOL_ESPERA_SEGUNDOS):
+        raise psycopg2.pool.PoolError("Todas as conexões com o banco estão em uso.")
     try:
-        yield conn
+        pool = _get_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            # Conexão derrubada pelo servidor é descartada em vez de voltar ao pool.
+            pool.putconn(conn, close=bool(conn.closed))
     finally:
-        conn.close()
-        
+        _pool_vagas.release()
+
+def _repetir_se_conexao_caiu(func):
+    # Só para operações que podem ser repetidas sem efeito duplicado. Erros sem
+    # pgcode vêm do cliente (conexão perdida), não de um comando rejeitado.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if e.pgcode is not None:
+                raise
+            return func(*args, **kwargs)
+    return wrapper
+
 def get_horario_padrao(filial: int, proximo_evento: str) -> time:
-    if filial in (3, 4):
-        return time(7, 30) if proximo_evento == "Entrada" else time(17, 30)
-    return time(8, 0) if proximo_evento == "Entrada" else time(18, 0)        
+    horarios = HORARIOS_POR_FILIAL.get(filial, HORARIOS_PADRAO)
+    return horarios["Entrada"] if proximo_evento == "Entrada" else horarios["Saída"]
+
+FILIAL_NUM_MAX = 32767  # limite do SMALLINT de funcionarios.filial_num
+
+def _numero_da_filial(filial) -> Optional[int]:
+    m = re.search(r'\d+', str(filial)) if filial else None
+    if not m or int(m.group()) > FILIAL_NUM_MAX:
+        return None
+    return int(m.group())
+
 
+def _clamp_diff(diff: int, tol: int = TOLERANCIA_MINUTOS) -> int:
+    # Dentro da tolerância conta como 0; fora dela, desconta a tolerância.
+    a = abs(diff)
+    return ((diff > 0) - (diff < 0)) * (a - tol if a > tol else 0)
 
-def _hash_senha(senha: str) -> str:
+
+ALGO_SHA256 = 0
+ALGO_ARGON2ID = 1
+
+def _hash_senha(senha: str, salt: bytes) -> str:
+    return hash_secret_raw(
+        senha.encode('utf-8'), salt,
+        time_cost=2, memory_cost=19 * 1024, parallelism=1, hash_len=32, type=Type.ID,
+    ).hex()
+
+def _hash_senha_sha256(senha: str) -> str:
     return hashlib.sha256(senha.encode('utf-8')).hexdigest()
 
+def _gerar_senha(senha: str) -> tuple:
+    salt = os.urandom(16)
+    return _hash_senha(senha, salt), salt
+
+HASH_MAX_THREADS = 4
+
+def _threads_de_hash() -> int:
+    # Cada hash ocupa 19 MiB enquanto roda, e os.cpu_count() enxerga as CPUs do
+    # host mesmo dentro de um contêiner limitado.
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return min(HASH_MAX_THREADS, cpus)
+
+def _hash_senhas(senhas) -> list:
+    # O argon2 libera o GIL durante o cálculo, então threads rodam em paralelo.
+    with ThreadPoolExecutor(max_workers=_threads_de_hash()) as executor:
+        return list(executor.map(_gerar_senha, senhas))
+
+def _senha_confere(senha: str, senha_hash: str, salt, algo: int) -> bool:
+    if algo == ALGO_ARGON2ID:
+        calculado = _hash_senha(senha, bytes(salt))
+    else:
+        calculado = _hash_senha_sha256(senha)
+    return hmac.compare_digest(calculado, senha_hash)
+
+@_repetir_se_conexao_caiu
 def init_db():
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
@@ -80,135 +202,202 @@ def init_db():
                     cod_tipo TEXT,
                     tipo TEXT,
                     filial TEXT,
+                    filial_num SMALLINT,
+                    salt BYTEA,
+                    algo SMALLINT NOT NULL DEFAULT 0,
                     FOREIGN KEY (empresa_id) REFERENCES empresas (id)
                 )
             ''')
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS registros (
-                    id TEXT PRIMARY KEY,
+                    id BIGSERIAL PRIMARY KEY,
                     cpf_funcionario TEXT NOT NULL,
                     nome TEXT NOT NULL,
-                    data TEXT NOT NULL,
-                    hora TEXT NOT NULL,
+                    data DATE NOT NULL,
+                    hora TIME NOT NULL,
                     descricao TEXT NOT NULL,
                     diferenca_min INTEGER NOT NULL,
                     observacao TEXT,
                     FOREIGN KEY (cpf_funcionario) REFERENCES funcionarios (cpf)
                 )
             ''')
-            
-            cursor.execute("SELECT COUNT(*) FROM funcionarios")
-            if cursor.fetchone()[0] == 0:
-                initial_users = [('admin', 'admin', 'Administrador', _hash_senha('admin123'), 'admin', None, None, None, None)]
-                cursor.executemany("INSERT INTO funcionarios (cpf, codigo, nome, senha, role, empresa_id, cod_tipo, tipo, filial) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)", initial_users)
+            cursor.execute('ALTER TABLE funcionarios ADD COLUMN IF NOT EXISTS filial_num SMALLINT')
+            cursor.execute('ALTER TABLE funcionarios ADD COLUMN IF NOT EXISTS salt BYTEA')
+            cursor.execute('ALTER TABLE funcionarios ADD COLUMN IF NOT EXISTS algo SMALLINT NOT NULL DEFAULT 0')
+            cursor.execute(
+                "UPDATE funcionarios SET filial_num = substring(filial from '\\d+')::smallint "
+                "WHERE filial_num IS NULL AND filial ~ '\\d' AND substring(filial from '\\d+')::numeric <= %s",
+                (FILIAL_NUM_MAX,)
+            )
+            cursor.execute(
+                "SELECT data_type FROM information_schema.columns "
+                "WHERE table_name = 'registros' AND column_name = 'data'"
+            )
+            if cursor.fetchone()['data_type'] == 'text':
+                cursor.execute(
+                    "ALTER TABLE registros "
+                    "ALTER COLUMN data TYPE DATE USING data::date, "
+                    "ALTER COLUMN hora TYPE TIME USING hora::time"
+                )
+            cursor.execute(
+                "SELECT data_type FROM information_schema.columns "
+                "WHERE table_name = 'registros' AND column_name = 'id'"
+            )
+            if cursor.fetchone()['data_type'] == 'text':
+                cursor.execute("ALTER TABLE registros DROP COLUMN id")
+                cursor.execute("ALTER TABLE registros ADD COLUMN id BIGSERIAL PRIMARY KEY")
+            cursor.execute("SELECT to_regclass('ux_registros_cpf_data_hora') AS indice")
+            if cursor.fetchone()['indice'] is None:
+                # Pontos repetidos no mesmo segundo impedem o índice único. Nada é
+                # apagado aqui: a limpeza fica para um script avulso, e o índice é
+                # criado na próxima inicialização sem conflitos.
+                cursor.execute('''
+                    SELECT COUNT(*) AS total FROM (
+                        SELECT 1 FROM registros GROUP BY cpf_funcionario, data, hora HAVING COUNT(*) > 1
+                    ) repetidos
+                ''')
+                repetidos = cursor.fetchone()['total']
+                if repetidos:
+                    print(f"⚠️ Índice único de registros não criado: {repetidos} grupo(s) de pontos no mesmo horário.")
+                else:
+                    cursor.execute('CREATE UNIQUE INDEX ux_registros_cpf_data_hora ON registros (cpf_funcionario, data, hora)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS ix_registros_data_cpf ON registros (data, cpf_funcionario)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS ix_func_login ON funcionarios (cpf) INCLUDE (senha, salt, algo, codigo, nome, role, empresa_id, filial)')
+            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_empresas_lower_nome ON empresas (lower(nome_empresa))')
+
+            cursor.execute("SELECT COUNT(*) AS total FROM funcionarios")
+            if cursor.fetchone()['total'] == 0:
+                senha_hash, salt = _gerar_senha('admin123')
+                initial_users = [('admin', 'admin', 'Administrador', senha_hash, 'admin', None, None, None, None, salt, ALGO_ARGON2ID)]
+                cursor.executemany("INSERT INTO funcionarios (cpf, codigo, nome, senha, role, empresa_id, cod_tipo, tipo, filial, salt, algo) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", initial_users)
         conn.commit()
 
 def _obter_ou_criar_empresa_id(nome_empresa, cnpj, cursor):
     cursor.execute("SELECT id FROM empresas WHERE lower(nome_empresa) = lower(%s)", (nome_empresa,))
     resultado = cursor.fetchone()
     if resultado:
-        cursor.execute("UPDATE empresas SET cnpj = %s WHERE id = %s", (cnpj, resultado[0]))
-        return resultado[0]
+        cursor.execute("UPDATE empresas SET cnpj = %s WHERE id = %s", (cnpj, resultado['id']))
+        return resultado['id']
     else:
         cursor.execute("INSERT INTO empresas (nome_empresa, cnpj) VALUES (%s, %s) RETURNING id", (nome_empresa, cnpj))
-        return cursor.fetchone()[0]
+        return cursor.fetchone()['id']
+
+EMPRESAS_CACHE_TTL = 60
+
+_empresas_cache = {"ts": 0, "df": None}
+_empresas_cache_lock = threading.Lock()
+
+def _invalidar_cache_empresas():
+    with _empresas_cache_lock:
+        _empresas_cache["ts"] = 0
 
 def ler_empresas():
-    with get_db_connection() as conn:
-        return query_df("SELECT id, nome_empresa, cnpj FROM empresas ORDER BY nome_empresa")
+    with _empresas_cache_lock:
+        if _empresas_cache["df"] is None or _time.time() - _empresas_cache["ts"] >= EMPRESAS_CACHE_TTL:
+            _empresas_cache["df"] = query_df("SELECT id, nome_empresa, cnpj FROM empresas ORDER BY nome_empresa")
+            _empresas_cache["ts"] = _time.time()
+        return _empresas_cache["df"].copy()
 
 def ler_funcionarios_df():
-    with get_db_connection() as conn:
-        query = "SELECT f.codigo, f.nome, f.cpf, f.cod_tipo, f.tipo, f.filial, f.role, f.empresa_id, e.nome_empresa, e.cnpj FROM funcionarios f LEFT JOIN empresas e ON f.empresa_id = e.id"
-        return query_df(query)
+    query = "SELECT f.codigo, f.nome, f.cpf, f.cod_tipo, f.tipo, f.filial, f.role, f.empresa_id, e.nome_empresa, e.cnpj FROM funcionarios f LEFT JOIN empresas e ON f.empresa_id = e.id"
+    return query_df(query)
+
+_SALT_FICTICIO = os.urandom(16)
 
+@_repetir_se_conexao_caiu
 def verificar_login(cpf, senha_cod_forte):
-    senha_hash = _hash_senha(senha_cod_forte)
     user = None
     with get_db_connection() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-            cursor.execute("SELECT * FROM funcionarios WHERE cpf = %s AND senha = %s", (cpf, senha_hash))
-            user = cursor.fetchone()
-    return (dict(user), None) if user else (None, "CPF ou Senha (Código Forte) inválidos.")
-
-def obter_proximo_evento(cpf):
-    hoje_str = datetime.now(FUSO_HORARIO).strftime("%Y-%m-%d")
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
             cursor.execute(
-                "SELECT COUNT(*) AS total FROM registros WHERE cpf_funcionario = %s AND data = %s",
-                (cpf, hoje_str)
+                "SELECT cpf, codigo, nome, role, empresa_id, filial, senha, salt, algo FROM funcionarios WHERE cpf = %s",
+                (cpf,)
             )
-            result = cursor.fetchone()
-
-            if result is None:
-                num_pontos = 0
-            elif isinstance(result, dict):
-                num_pontos = result.get("total", 0)
-            else:
-                num_pontos = result[0] if len(result) > 0 else 0
+            row = cursor.fetchone()
+            if row is None:
+                # Mesmo custo de um login válido, para não revelar quais CPFs existem.
+                _hash_senha(senha_cod_forte, _SALT_FICTICIO)
+            elif _senha_confere(senha_cod_forte, row['senha'], row['salt'], row['algo']):
+                user = {k: row[k] for k in ('cpf', 'codigo', 'nome', 'role', 'empresa_id', 'filial')}
+                if row['algo'] != ALGO_ARGON2ID:
+                    senha_hash, salt = _gerar_senha(senha_cod_forte)
+                    cursor.execute(
+                        "UPDATE funcionarios SET senha = %s, salt = %s, algo = %s WHERE cpf = %s",
+                        (senha_hash, salt, ALGO_ARGON2ID, cpf)
+                    )
+                    conn.commit()
+    return (user, None) if user else (None, "CPF ou Senha (Código Forte) inválidos.")
 
+def _evento_por_contagem(num_pontos):
     eventos = list(HORARIOS_PADRAO.keys())
     return eventos[num_pontos] if num_pontos < len(eventos) else "Jornada Finalizada"
 
-
-def bater_ponto(cpf, nome):
-    agora = datetime.now(FUSO_HORARIO)
-    proximo_evento = obter_proximo_evento(cpf)
-    if proximo_evento == "Jornada Finalizada":
-        return "Sua jornada de hoje já foi completamente registada.", "warning"
-
+@_repetir_se_conexao_caiu
+def obter_proximo_evento(cpf):
+    hoje = datetime.now(FUSO_HORARIO).date()
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
+            # Só interessam os primeiros len(HORARIOS_PADRAO) pontos do dia.
             cursor.execute(
-                "SELECT filial FROM funcionarios WHERE cpf = %s",
-                (cpf,)
+                "SELECT 1 FROM registros WHERE cpf_funcionario = %s AND data = %s LIMIT %s",
+                (cpf, hoje, len(HORARIOS_PADRAO))
             )
-            resultado = cursor.fetchone()
-    filial = resultado[0] if resultado else None
+            num_pontos = len(cursor.fetchall())
 
-    if filial in ("Filial 03", "Filial 3", "Filial 04", "Filial 4"):
-        horarios = {
-            "Entrada": time(7, 30),
-            "Saída":   time(17, 30)
-        }
-    else:
-        horarios = HORARIOS_PADRAO
-
-    hora_prevista     = horarios[proximo_evento]
-    datetime_previsto = agora.replace(
-        hour=hora_prevista.hour,
-        minute=hora_prevista.minute,
-        second=0,
-        microsecond=0
-    )
+    return _evento_por_contagem(num_pontos)
 
-    diff_bruta = round((agora - datetime_previsto).total_seconds() / 60)
-    diff_final = (
-        0 if abs(diff_bruta) <= TOLERANCIA_MINUTOS
-        else diff_bruta - TOLERANCIA_MINUTOS
-        if diff_bruta > 0
-        else diff_bruta + TOLERANCIA_MINUTOS
-    )
 
-    novo_reg = (
-        f"{cpf}-{agora.isoformat()}",
-        cpf,
-        nome,
-        agora.strftime("%Y-%m-%d"),
-        agora.strftime("%H:%M:%S"),
-        proximo_evento,
-        diff_final,
-        ""
-    )
+def bater_ponto(cpf, nome):
+    agora = datetime.now(FUSO_HORARIO)
 
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO registros (id, cpf_funcionario, nome, data, hora, descricao, diferenca_min, observacao) "
-                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-                novo_reg
+            # Filial e pontos do dia numa única ida ao banco.
+            cursor.execute("""
+                WITH f AS (SELECT filial_num FROM funcionarios WHERE cpf = %s),
+                     c AS (SELECT COUNT(*) AS n FROM (
+                         SELECT 1 FROM registros WHERE cpf_funcionario = %s AND data = %s LIMIT %s
+                     ) p)
+                SELECT f.filial_num, c.n FROM c LEFT JOIN f ON TRUE
+            """, (cpf, cpf, agora.date(), len(HORARIOS_PADRAO)))
+            resultado = cursor.fetchone()
+            filial_num = resultado['filial_num'] if resultado else None
+            num_pontos = resultado['n'] if resultado else 0
+
+            proximo_evento = _evento_por_contagem(num_pontos)
+            if proximo_evento == "Jornada Finalizada":
+                return "Sua jornada de hoje já foi completamente registada.", "warning"
+
+            hora_prevista     = get_horario_padrao(filial_num, proximo_evento)
+            datetime_previsto = agora.replace(
+                hour=hora_prevista.hour,
+                minute=hora_prevista.minute,
+                second=0,
+                microsecond=0
+            )
+
+            diff_bruta = round((agora - datetime_previsto).total_seconds() / 60)
+            diff_final = _clamp_diff(diff_bruta)
+
+            novo_reg = (
+                cpf,
+                nome,
+                agora.date(),
+                agora.time().replace(microsecond=0),
+                proximo_evento,
+                diff_final,
+                ""
             )
+
+            try:
+                cursor.execute(
+                    "INSERT INTO registros (cpf_funcionario, nome, data, hora, descricao, diferenca_min, observacao) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                    novo_reg
+                )
+            except psycopg2.errors.UniqueViolation:
+                conn.rollback()
+                return "Já existe um ponto registado neste mesmo horário.", "warning"
         conn.commit()
 
     msg_extra = ""
@@ -231,33 +420,57 @@ def bater_ponto(cpf, nome):
         "success"
     )
 
-def ler_registros_df():
-    with get_db_connection() as conn:
-        query = "SELECT r.id, f.codigo, r.nome, r.data, r.hora, r.descricao, r.diferenca_min, r.observacao, e.nome_empresa, e.cnpj, f.tipo as setor, f.filial FROM registros r JOIN funcionarios f ON r.cpf_funcionario = f.cpf LEFT JOIN empresas e ON f.empresa_id = e.id"
-        df = query_df(query)
+def _filtros_registros(data_inicio=None, data_fim=None, empresa_id=None, filial=None, setor=None, codigo=None):
+    condicoes, params = [], {}
+    for condicao, chave, valor in (("r.data >= :data_inicio", "data_inicio", data_inicio), ("r.data <= :data_fim", "data_fim", data_fim),
+                                   ("f.empresa_id = :empresa_id", "empresa_id", empresa_id), ("f.filial = :filial", "filial", filial),
+                                   ("f.tipo = :setor", "setor", setor), ("f.codigo = :codigo", "codigo", codigo)):
+        if valor is not None:
+            condicoes.append(condicao)
+            params[chave] = valor
+    return (" WHERE " + " AND ".join(condicoes) if condicoes else ""), params
+
+# Colunas com poucos valores distintos viram category; Hora segue como texto
+# HH:MM:SS, que é como a tela a mostra e edita.
+_REGISTROS_DTYPES = {
+    'id': 'int64', 'diferenca_min': 'int64',
+    'descricao': 'category', 'nome_empresa': 'category', 'setor': 'category', 'filial': 'category',
+}
+
+def ler_registros_df(data_inicio=None, data_fim=None, empresa_id=None, filial=None, setor=None, codigo=None):
+    where, params = _filtros_registros(data_inicio, data_fim, empresa_id, filial, setor, codigo)
+    query = "SELECT r.id, f.codigo, r.nome, r.data, to_char(r.hora, 'HH24:MI:SS') AS hora, r.descricao, r.diferenca_min, r.observacao, e.nome_empresa, e.cnpj, f.tipo as setor, f.filial FROM registros r JOIN funcionarios f ON r.cpf_funcionario = f.cpf LEFT JOIN empresas e ON f.empresa_id = e.id" + where
+    df = query_df(query, params, stream=True, dtype=_REGISTROS_DTYPES, parse_dates=['data'])
     return df.rename(columns={'id': 'ID', 'codigo': 'Código Forte', 'nome': 'Nome', 'data': 'Data', 'hora': 'Hora', 'descricao': 'Descrição', 'diferenca_min': 'Diferença (min)', 'observacao': 'Observação', 'nome_empresa': 'Empresa', 'cnpj': 'CNPJ', 'setor': 'Setor', 'filial': 'Filial'})
 
+def query_relatorio(data_inicio, data_fim, empresa_id=None, filial=None, setor=None, codigo=None):
+    # Uma linha por funcionário/dia, já com Entrada e Saída lado a lado.
+    where, params = _filtros_registros(data_inicio, data_fim, empresa_id, filial, setor, codigo)
+    query = f"""
+        SELECT to_char(data, 'DD/MM/YYYY') AS data, codigo, nome, nome_empresa, cnpj, entrada, saida,
+               EXTRACT(EPOCH FROM saida - entrada)::bigint AS segundos, observacao
+        FROM (
+            SELECT r.data, f.codigo, r.nome, e.nome_empresa, e.cnpj,
+                   MIN(r.hora) FILTER (WHERE r.descricao IN ('Entrada', 'Início do Expediente')) AS entrada,
+                   MAX(r.hora) FILTER (WHERE r.descricao IN ('Saída', 'Fim do Expediente')) AS saida,
+                   string_agg(DISTINCT r.observacao, ' | ') FILTER (WHERE r.observacao <> '') AS observacao
+            FROM registros r
+            JOIN funcionarios f ON f.cpf = r.cpf_funcionario
+            LEFT JOIN empresas e ON e.id = f.empresa_id{where}
+            GROUP BY r.data, f.codigo, r.nome, e.nome_empresa, e.cnpj
+        ) dias
+        ORDER BY dias.data, codigo
+    """
+    return query_df(query, params)
+
 def atualizar_registro(id_registro, novo_horario=None, nova_observacao=None):
     try:
         with get_db_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+                id_registro = int(id_registro)
                 print(f"🛠️ Atualizando registro ID: {id_registro}")
 
-                cursor.execute("SELECT * FROM registros WHERE id = %s", (id_registro,))
-                registro_existente = cursor.fetchone()
-                if not registro_existente:
-                    print("❌ Registro não encontrado")
-                    return "Registro não encontrado.", "error"
-
-                campos_atualizados = 0
-
-                if nova_observacao is not None:
-                    cursor.execute(
-                        "UPDATE registros SET observacao = %s WHERE id = %s",
-                        (nova_observacao, id_registro)
-                    )
-                    campos_atualizados += cursor.rowcount
-
+                novo_obj = None
                 if novo_horario is not None:
                     try:
                         novo_obj = datetime.strptime(novo_horario, "%H:%M:%S").time()
@@ -265,48 +478,40 @@ def atualizar_registro(id_registro, novo_horario=None, nova_observacao=None):
                         print("❌ Horário inválido recebido")
                         return "Formato de hora inválido. Use HH:MM:SS.", "error"
 
+                cursor.execute("""
+                    SELECT r.descricao, r.data, f.filial_num
+                    FROM registros r
+                    JOIN funcionarios f ON f.cpf = r.cpf_funcionario
+                    WHERE r.id = %s
+                    FOR UPDATE OF r
+                """, (id_registro,))
+                row = cursor.fetchone()
+                if not row:
+                    print("❌ Registro não encontrado")
+                    return "Registro não encontrado.", "error"
+
+                diff_final = None
+                if novo_obj is not None:
+                    data_reg = row['data']
+                    hora_prevista = get_horario_padrao(row['filial_num'], row['descricao'])
+
+                    dt_previsto = datetime.combine(data_reg, hora_prevista.replace(second=0, microsecond=0))
+                    dt_novo = datetime.combine(data_reg, novo_obj.replace(second=0, microsecond=0))
+
+                    diff_bruta = round((dt_novo - dt_previsto).total_seconds() / 60)
+
+                    diff_final = _clamp_diff(diff_bruta)
+
+                campos_atualizados = 0
+                if novo_obj is not None or nova_observacao is not None:
                     cursor.execute("""
-                        SELECT r.descricao, r.data, r.cpf_funcionario, f.filial
-                        FROM registros r
-                        JOIN funcionarios f ON f.cpf = r.cpf_funcionario
-                        WHERE r.id = %s
-                    """, (id_registro,))
-                    row = cursor.fetchone()
-
-                    if row:
-                        descricao = row['descricao']
-                        data_str = row['data']
-                        filial_tx = row['filial']
-
-                        filial_num = None
-                        if filial_tx:
-                            m = re.search(r'\d+', str(filial_tx))
-                            filial_num = int(m.group()) if m else None
-
-                        hora_prevista = get_horario_padrao(filial_num, descricao)
-
-                        dt_reg_dia = datetime.strptime(data_str, "%Y-%m-%d")
-                        dt_previsto = dt_reg_dia.replace(
-                            hour=hora_prevista.hour, minute=hora_prevista.minute, second=0, microsecond=0
-                        )
-                        dt_novo = dt_reg_dia.replace(
-                            hour=novo_obj.hour, minute=novo_obj.minute, second=0, microsecond=0
-                        )
-
-                        diff_bruta = round((dt_novo - dt_previsto).total_seconds() / 60)
-
-                        if abs(diff_bruta) <= TOLERANCIA_MINUTOS:
-                            diff_final = 0
-                        elif diff_bruta > 0:
-                            diff_final = diff_bruta - TOLERANCIA_MINUTOS
-                        else:
-                            diff_final = diff_bruta + TOLERANCIA_MINUTOS
-
-                        cursor.execute(
-                            "UPDATE registros SET hora = %s, diferenca_min = %s WHERE id = %s",
-                            (novo_horario, diff_final, id_registro)
-                        )
-                        campos_atualizados += cursor.rowcount
+                        UPDATE registros
+                        SET hora = COALESCE(%s, hora),
+                            observacao = COALESCE(%s, observacao),
+                            diferenca_min = COALESCE(%s, diferenca_min)
+                        WHERE id = %s
+                    """, (novo_obj, nova_observacao, diff_final, id_registro))
+                    campos_atualizados = cursor.rowcount
 
                 if campos_atualizados == 0:
                     print("⚠️ Nenhuma alteração feita")
@@ -326,6 +531,8 @@ def atualizar_registro(id_registro, novo_horario=None, nova_observacao=None):
 def adicionar_funcionario(codigo, nome, nome_empresa, cnpj, cpf, cod_tipo, tipo, filial):
     if not all([codigo, nome, nome_empresa, cpf]):
         return "Campos essenciais (Código Forte, Nome, Empresa, CPF) são obrigatórios.", "error"
+    # O argon2 roda antes de abrir a transação, e não com a empresa já travada.
+    senha_hash, salt = _gerar_senha(codigo)
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
@@ -334,72 +541,136 @@ def adicionar_funcionario(codigo, nome, nome_empresa, cnpj, cpf, cod_tipo, tipo,
                     return f"O CPF '{cpf}' já está em uso.", "warning"
                 
                 empresa_id = _obter_ou_criar_empresa_id(nome_empresa, cnpj, cursor)
-                senha_hash = _hash_senha(codigo)
                 cursor.execute(
-                    "INSERT INTO funcionarios (cpf, codigo, nome, senha, role, empresa_id, cod_tipo, tipo, filial) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                    (cpf, codigo, nome, senha_hash, 'employee', empresa_id, cod_tipo, tipo, filial)
+                    "INSERT INTO funcionarios (cpf, codigo, nome, senha, role, empresa_id, cod_tipo, tipo, filial, filial_num, salt, algo) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                    (cpf, codigo, nome, senha_hash, 'employee', empresa_id, cod_tipo, tipo, filial, _numero_da_filial(filial), salt, ALGO_ARGON2ID)
                 )
             conn.commit()
+        _invalidar_cache_empresas()
     except psycopg2.Error as e: return f"Erro no banco de dados: {e}", "error"
     return f"Funcionário '{nome}' adicionado com sucesso!", "success"
 
+_FILIAL_RE = re.compile(r'(matriz)|filial 0?([234])', re.IGNORECASE)
+
 def _extrair_filial_do_texto(texto_arquivo):
-    texto_lower = texto_arquivo.lower()
-    if "matriz" in texto_lower: return "Matriz"
-    if "filial 02" in texto_lower or "filial 2" in texto_lower: return "Filial 02"
-    if "filial 03" in texto_lower or "filial 3" in texto_lower: return "Filial 03"
-    if "filial 04" in texto_lower or "filial 4" in texto_lower: return "Filial 04"
-    return "Não Identificada"
+    m = _FILIAL_RE.search(texto_arquivo)
+    if not m: return "Não Identificada"
+    return "Matriz" if m.group(1) else f"Filial 0{m.group(2)}"
+
+_COLUNAS_FUNCIONARIOS = "cpf, codigo, nome, senha, role, empresa_id, cod_tipo, tipo, filial, filial_num, salt, algo"
+
+def _valor_copy(valor):
+    if valor is None: return r'\N'
+    if isinstance(valor, bytes): return '\\x' + valor.hex()
+    return valor
+
+def _copiar_funcionarios(cursor, linhas):
+    # COPY não aceita ON CONFLICT: carrega numa tabela temporária e insere dali.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter='\t', lineterminator='\n')
+    writer.writerows([_valor_copy(valor) for valor in linha] for linha in linhas)
+    buffer.seek(0)
+    cursor.execute("CREATE TEMP TABLE funcionarios_import (LIKE funcionarios) ON COMMIT DROP")
+    cursor.copy_expert(
+        f"COPY funcionarios_import ({_COLUNAS_FUNCIONARIOS}) FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t', NULL '\\N')",
+        buffer,
+    )
+    cursor.execute(
+        f"INSERT INTO funcionarios ({_COLUNAS_FUNCIONARIOS}) SELECT {_COLUNAS_FUNCIONARIOS} FROM funcionarios_import "
+        "ON CONFLICT (cpf) DO NOTHING RETURNING cpf"
+    )
+    return len(cursor.fetchall())
 
 def importar_funcionarios_em_massa(df_funcionarios):
-    novos_funcionarios, erros, sucesso_count, ignorados_count = [], [], 0, 0
-    cpfs_existentes = ler_funcionarios_df()['cpf'].tolist()
+    pendentes, erros, sucesso_count, ignorados_count = [], [], 0, 0
+    cpfs_existentes = set(ler_funcionarios_df()['cpf'])
     
     colunas_necessarias = ['ARQUIVO', 'EMPRESA', 'CNPJ', 'CODTIPO', 'TIPO', 'CODFORTE', 'NOME', 'CPF']
     if not all(col.upper() in df_funcionarios.columns for col in colunas_necessarias):
         return 0, 0, [f"Erro Crítico: Verifique se as colunas {colunas_necessarias} existem no arquivo."]
 
+    empresas_existentes_df = ler_empresas()
+    empresas_existentes = dict(zip(empresas_existentes_df['nome_empresa'].str.lower(), empresas_existentes_df['id'].tolist()))
+    empresas_novas = {}
+
+    for index, row in df_funcionarios.iterrows():
+        try:
+            filial = _extrair_filial_do_texto(str(row['ARQUIVO']))
+            nome_empresa = str(row['EMPRESA']).strip()
+            cnpj = str(row['CNPJ']).strip()
+            cod_tipo = str(row['CODTIPO']).strip()
+            tipo = str(row['TIPO']).strip()
+            codigo = str(row['CODFORTE']).strip()
+            nome = str(row['NOME']).strip()
+            cpf_raw = str(row['CPF']).strip()
+            
+            if cpf_raw in cpfs_existentes:
+                ignorados_count += 1
+                continue
+            if not all([codigo, nome, cpf_raw, nome_empresa]):
+                erros.append(f"Linha {index+2}: Dados essenciais (CodForte, Nome, CPF, Empresa) incompletos.")
+                continue
+            
+            chave_empresa = nome_empresa.lower()
+            if chave_empresa not in empresas_existentes:
+                empresas_novas.setdefault(chave_empresa, (nome_empresa, cnpj))
+
+            pendentes.append((index+2, cpf_raw, codigo, nome, 'employee', chave_empresa, cod_tipo, tipo, filial, _numero_da_filial(filial)))
+            cpfs_existentes.add(cpf_raw)
+        except Exception as e:
+            erros.append(f"Linha {index+2}: Erro - {e}")
+
+    if not pendentes:
+        return sucesso_count, ignorados_count, erros
+
+    # O argon2 roda antes de pegar a conexão: nenhuma transação fica aberta,
+    # segurando locks e uma conexão do pool, durante os hashes.
+    senhas = _hash_senhas([reg[2] for reg in pendentes])
+
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            empresas_existentes_df = ler_empresas()
-            empresas_existentes = dict(zip(empresas_existentes_df['nome_empresa'].str.lower(), empresas_existentes_df['id']))
-
-            for index, row in df_funcionarios.iterrows():
-                try:
-                    filial = _extrair_filial_do_texto(str(row['ARQUIVO']))
-                    nome_empresa = str(row['EMPRESA']).strip()
-                    cnpj = str(row['CNPJ']).strip()
-                    cod_tipo = str(row['CODTIPO']).strip()
-                    tipo = str(row['TIPO']).strip()
-                    codigo = str(row['CODFORTE']).strip()
-                    nome = str(row['NOME']).strip()
-                    cpf_raw = str(row['CPF']).strip()
-                    
-                    if cpf_raw in cpfs_existentes:
-                        ignorados_count += 1
-                        continue
-                    if not all([codigo, nome, cpf_raw, nome_empresa]):
-                        erros.append(f"Linha {index+2}: Dados essenciais (CodForte, Nome, CPF, Empresa) incompletos.")
+            try:
+                if empresas_novas:
+                    criadas = psycopg2.extras.execute_values(
+                        cursor,
+                        "INSERT INTO empresas (nome_empresa, cnpj) VALUES %s "
+                        "ON CONFLICT (lower(nome_empresa)) DO UPDATE SET cnpj = EXCLUDED.cnpj "
+                        "RETURNING id, nome_empresa",
+                        list(empresas_novas.values()),
+                        page_size=1000,
+                        fetch=True,
+                    )
+                    # A chave sai do lower() do Python, como em empresas_existentes: o
+                    # lower() do Postgres pode não converter acentos (collation C).
+                    empresas_existentes.update((r['nome_empresa'].lower(), r['id']) for r in criadas)
+
+                novos_funcionarios = []
+                for (linha, cpf_raw, codigo, nome, role, chave_empresa, cod_tipo, tipo, filial, filial_num), (senha_hash, salt) in zip(pendentes, senhas):
+                    empresa_id = empresas_existentes.get(chave_empresa)
+                    if empresa_id is None:
+                        erros.append(f"Linha {linha}: Empresa não encontrada após o cadastro.")
                         continue
-                    
-                    empresa_id = empresas_existentes.get(nome_empresa.lower())
-                    if not empresa_id:
-                        empresa_id = _obter_ou_criar_empresa_id(nome_empresa, cnpj, cursor)
-                        empresas_existentes[nome_empresa.lower()] = empresa_id
-
-                    senha_hash = _hash_senha(codigo)
-                    novos_funcionarios.append((cpf_raw, codigo, nome, senha_hash, 'employee', empresa_id, cod_tipo, tipo, filial))
-                    cpfs_existentes.append(cpf_raw)
-                except Exception as e:
-                    erros.append(f"Linha {index+2}: Erro - {e}")
-            
-            if novos_funcionarios:
+                    novos_funcionarios.append((cpf_raw, codigo, nome, senha_hash, role, empresa_id, cod_tipo, tipo, filial, filial_num, salt, ALGO_ARGON2ID))
+                cursor.execute("SAVEPOINT importar_copy")
                 try:
-                    cursor.executemany("INSERT INTO funcionarios (cpf, codigo, nome, senha, role, empresa_id, cod_tipo, tipo, filial) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)", novos_funcionarios)
-                    sucesso_count = len(novos_funcionarios)
-                except psycopg2.Error as e:
-                    erros.append(f"Erro geral no banco de dados: {e}")
+                    sucesso_count = _copiar_funcionarios(cursor, novos_funcionarios)
+                except psycopg2.Error:
+                    cursor.execute("ROLLBACK TO SAVEPOINT importar_copy")
+                    inseridos = psycopg2.extras.execute_values(
+                        cursor,
+                        f"INSERT INTO funcionarios ({_COLUNAS_FUNCIONARIOS}) VALUES %s "
+                        "ON CONFLICT (cpf) DO NOTHING RETURNING cpf",
+                        novos_funcionarios,
+                        page_size=1000,
+                        fetch=True,
+                    )
+                    sucesso_count = len(inseridos)
+                ignorados_count += len(novos_funcionarios) - sucesso_count
+            except psycopg2.Error as e:
+                erros.append(f"Erro geral no banco de dados: {e}")
         conn.commit()
+    if empresas_novas:
+        _invalidar_cache_empresas()
         
     return sucesso_count, ignorados_count, erros
 
@@ -414,33 +685,36 @@ def excluir_funcionario(cpf):
     except psycopg2.Error as e:
         return f"Erro no banco de dados ao excluir funcionário: {e}", "error"
 
-def _formatar_timedelta(td):
-    if pd.isnull(td): return "00:00"
-    total_seconds = int(td.total_seconds())
-    hours, remainder = divmod(total_seconds, 3600)
-    minutes, _ = divmod(remainder, 60)
-    return f"{hours:02d}:{minutes:02d}"
-
-def gerar_relatorio_organizado_df(df_registros: pd.DataFrame) -> pd.DataFrame:
-    if df_registros.empty: return pd.DataFrame()
-    df = df_registros.copy()
-    df['Descrição'] = df['Descrição'].replace({"Início do Expediente": "Entrada", "Fim do Expediente": "Saída"})
-    df_pivot = df.pivot_table(index=['Data', 'Código Forte', 'Nome', 'Empresa', 'CNPJ'], columns='Descrição', values='Hora', aggfunc='first').reset_index()
-    df_obs = df.dropna(subset=['Observação']).groupby(['Data', 'Código Forte'])['Observação'].apply(lambda x: ' | '.join(x.unique())).reset_index()
-    df_final = pd.merge(df_pivot, df_obs, on=['Data', 'Código Forte'], how='left').fillna({'Observação': ''})
-    for evento in ['Entrada', 'Saída']:
-        if evento not in df_final.columns: df_final[evento] = np.nan
-        df_final[evento] = pd.to_datetime(df_final[evento], format='%H:%M:%S', errors='coerce').dt.time
-    dt_entrada = pd.to_datetime(df_final['Data'].astype(str) + ' ' + df_final['Entrada'].astype(str), errors='coerce')
-    dt_saida = pd.to_datetime(df_final['Data'].astype(str) + ' ' + df_final['Saída'].astype(str), errors='coerce')
-    df_final['Total Horas Trabalhadas'] = (dt_saida - dt_entrada).apply(_formatar_timedelta)
-    colunas = ['Data', 'Código Forte', 'Nome', 'Empresa', 'CNPJ', 'Entrada', 'Saída', 'Total Horas Trabalhadas', 'Observação']
-    for col in colunas:
-        if col not in df_final.columns: df_final[col] = 'N/A'
-    df_final = df_final[colunas]
-    df_final.rename(columns={'Código Forte': 'Código do Funcionário', 'Nome': 'Nome do Funcionário'}, inplace=True)
-    df_final['Data'] = pd.to_datetime(df_final['Data']).dt.strftime('%d/%m/%Y')
-    return df_final
+def _formatar_timedeltas(td: pd.Series) -> pd.Series:
+    valores = td.values.astype('timedelta64[ns]')
+    ns = valores.astype('int64')
+    # int(td.total_seconds()) trunca em direção a zero; NaT vira 00:00.
+    total_seconds = np.where(ns < 0, -(-ns // 10**9), ns // 10**9)
+    total_seconds = np.where(np.isnat(valores), 0, total_seconds)
+    hours, remainder = np.divmod(total_seconds, 3600)
+    minutes = remainder // 60
+    return pd.Series([f"{h:02d}:{m:02d}" for h, m in zip(hours.tolist(), minutes.tolist())], index=td.index)
+
+def gerar_relatorio_organizado_df(df_relatorio: pd.DataFrame) -> pd.DataFrame:
+    if df_relatorio.empty: return pd.DataFrame()
+    return pd.DataFrame({
+        'Data': df_relatorio['data'],
+        'Código do Funcionário': df_relatorio['codigo'],
+        'Nome do Funcionário': df_relatorio['nome'],
+        'Empresa': df_relatorio['nome_empresa'],
+        'CNPJ': df_relatorio['cnpj'],
+        'Entrada': df_relatorio['entrada'],
+        'Saída': df_relatorio['saida'],
+        'Total Horas Trabalhadas': _formatar_timedeltas(pd.to_timedelta(df_relatorio['segundos'], unit='s')),
+        'Observação': df_relatorio['observacao'].fillna(''),
+    })
+
+def _larguras_colunas(df: pd.DataFrame) -> list:
+    larguras = []
+    for i, col in enumerate(df.columns):
+        maior_valor = df.iloc[:, i].astype(str).str.len().max()
+        larguras.append(max(len(str(col)), 0 if pd.isna(maior_valor) else int(maior_valor)) + 2)
+    return larguras
 
 def gerar_arquivo_excel(df_organizado, df_bruto, nome_empresa, cnpj, data_inicio, data_fim):
     output_buffer = io.BytesIO()
@@ -471,23 +745,10 @@ def gerar_arquivo_excel(df_organizado, df_bruto, nome_empresa, cnpj, data_inicio
         sheet_diario['A3'] = "Período:"
         sheet_diario['B3'] = periodo_str
         sheet_diario['A3'].font = font_info
-        for sheet_name in writer.sheets:
+        for sheet_name, df in (('Relatório Diário', df_organizado), ('Log de Eventos (Bruto)', df_bruto)):
             worksheet = writer.sheets[sheet_name]
-            for i, column_cells in enumerate(worksheet.columns, 1):
-                max_length = 0
-                column_letter = get_column_letter(i)
-                start_row = 5 if sheet_name == 'Relatório Diário' else 1
-                header_cell = worksheet.cell(row=start_row, column=i)
-                if header_cell.value:
-                    max_length = len(str(header_cell.value))
-                for cell in column_cells:
-                    if cell.row > start_row:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except: pass
-                adjusted_width = max(max_length, len(str(header_cell.value)) if header_cell.value else 0) + 2
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+            for i, largura in enumerate(_larguras_colunas(df), 1):
+                worksheet.column_dimensions[get_column_letter(i)].width = largura
     output_buffer.seek(0)
     return output_buffer
 